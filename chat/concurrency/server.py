@@ -3,32 +3,53 @@
 # Author    : lemon
 # Time      : 2020/6/11 11:37 
 
-"""基于多线程实现的多人聊天服务器端
+"""基于asyncio实现的多人聊天服务器端
 
 服务器功能:
     1.多用户同时聊天,用户上下线会进行全局通知
     2.服务器能查看所有在线的用户
     3.服务器可以给所有用户发消息
+
+每个客户端对应一个协程而不是一个线程,所有客户端共用一个事件循环,
+不再需要为每个连接分配线程栈,也不存在多线程同时修改clients的问题
 """
+import asyncio
+import codecs
+import functools
+import heapq
+import itertools
 import socket
-import threading
+import struct
 import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 from loguru import logger
 
+HEADER = struct.Struct('!H')  # 客户端消息的长度头: 2字节,网络字节序
+# 没有状态的多字节编码(codecs.lookup规范化后的名字),可以在整个运行期间复用同一个增量编解码器;
+# utf-8-sig、utf-16等编码器有状态(只在第一次输出BOM),不能共用
+STATELESS_MULTIBYTE_CODECS = frozenset(('gbk', 'gb2312', 'gb18030', 'big5', 'big5hkscs', 'cp950',
+                                        'shift_jis', 'cp932', 'euc_jp', 'euc_kr', 'cp949'))
+
 
 class ClientInfo:
-    def __init__(self, addr: str, handle_time: float):
+    __slots__ = ('addr', 'handle_time', 'addr_bytes', 'prefix_bytes', 'closed', 'outbuf', 'flush_handle')  # 每个在线客户端一个实例,不需要__dict__
+
+    def __init__(self, addr: str, handle_time: float, encoding: str = 'utf-8'):
         """客户端保持在服务的信息
 
         参数:
             addr:客户端地址
             handle_time:用于清理的标识时间 单位秒
+            encoding:编码
         """
         self.addr = addr
         self.handle_time = handle_time
+        self.addr_bytes = addr.encode(encoding)
+        self.prefix_bytes = self.addr_bytes + b': '  # 群发消息的前缀,注册时编码一次
         self.closed = False
+        self.outbuf = bytearray()  # 待发送的数据,攒成一批后一次性写出
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
 
 
 class SKTServer:
@@ -36,170 +57,284 @@ class SKTServer:
             self,
             host: str = '0.0.0.0',
             port: int = 8888,
-            buffer_size: int = 1024,
+            buffer_size: int = 65536,
             handle_time: float = 10.,
-            encoding: str = 'utf-8'
+            encoding: str = 'utf-8',
+            sndbuf: Optional[int] = None,
+            rcvbuf: Optional[int] = None,
+            batch_interval_ms: float = 1.,
+            batch_max_bytes: int = 1440,
+            max_backlog_bytes: int = 1024 * 1024,
     ) -> None:
         """socket服务器初始化函数
 
         参数:
             host:服务器ip
             port:服务器端口
-            buffer_size:接收消息的buffer size
+            buffer_size:每个连接的接收缓冲区上限(StreamReader的limit)
             handle_time:清理客户端的时间
             encoding:编码
+            sndbuf:已连接socket的发送缓冲区大小(SO_SNDBUF),为None时使用系统默认值
+            rcvbuf:已连接socket的接收缓冲区大小(SO_RCVBUF),为None时使用系统默认值
+                linux下实际生效的值受net.core.wmem_max/net.core.rmem_max限制
+            batch_interval_ms:消息最多攒多久再写出 单位毫秒
+            batch_max_bytes:攒够这么多字节就立即写出
+            max_backlog_bytes:单个客户端最多积压多少字节没发出去,超过后认为它接收太慢并断开
         """
         self.host = host
         self.port = port
         self.buffer_size = buffer_size
         self.handle_time = handle_time
         self.encoding = encoding
-        self.server = socket.socket()
-        self.clients: Dict[socket.socket, ClientInfo] = {}
+        if codecs.lookup(encoding).name in STATELESS_MULTIBYTE_CODECS:  # gbk等编码复用增量编解码器,省掉每次调用时查找、初始化编解码器的开销
+            encode = functools.partial(codecs.getincrementalencoder(encoding)().encode, final=True)
+            self._decode = functools.partial(codecs.getincrementaldecoder(encoding)().decode, final=True)
+        else:  # utf-8等有快速路径,有状态的编码每次调用都从头开始
+            encode = functools.partial(str.encode, encoding=encoding)
+            self._decode = functools.partial(bytes.decode, encoding=encoding)
+        # 相同的文本(管理员通知、在线列表等)只编码一次
+        self._encode = functools.lru_cache(maxsize=256)(encode)
+        self._encode_msg = encode  # 用户的私聊内容每条都不同,不放进缓存,免得把上面的固定文本挤出去
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.batch_interval = batch_interval_ms / 1000
+        self.batch_max_bytes = batch_max_bytes
+        self.max_backlog_bytes = max_backlog_bytes
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[asyncio.StreamWriter, ClientInfo] = {}
+        self.clients_by_addr: Dict[str, asyncio.StreamWriter] = {}  # 地址到客户端的索引,私聊时直接查找
+        self._client_list_cache: Optional[str] = None
+        self._client_writers: Tuple[asyncio.StreamWriter, ...] = ()  # clients的快照,群发时遍历
+        # 按到期时间排序的小顶堆(到期时间, 序号, 客户端),每个客户端一条记录
+        self.expirations: List[Tuple[float, int, asyncio.StreamWriter]] = []
+        self.expiry_seq = itertools.count()
 
-    def __init(self):
+    async def __init(self):
         """初始化服务器"""
         logger.info(f'初始化服务器...')
         try:
-            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 立即释放端口
-            self.server.bind((self.host, self.port))  # 绑定ip 端口
-            self.server.listen()  # 开启监听
+            # reuse_address: 立即释放端口
+            self.server = await asyncio.start_server(
+                self.__register, self.host, self.port, limit=self.buffer_size, reuse_address=True
+            )
         except OSError as e:
             logger.error('服务器启动失败，请检查端口是否被占用')
             raise e
         logger.info(f'服务器启动成功,绑定地址为:{self.host}:{self.port}')
 
-    def __register(self, conn: socket.socket, addr: str) -> None:
+    async def __register(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
         """注册连接"""
-        self.clients[conn] = ClientInfo(addr, time.time())
+        host, port = writer.get_extra_info('peername')[:2]
+        addr = f'{host}:{port}'
+        self.__tune_socket(writer.get_extra_info('socket'))
+        self.clients[writer] = ClientInfo(addr, time.time(), self.encoding)
+        self.clients_by_addr[addr] = writer
+        self.__clients_changed()
+        self.__schedule_expiry(writer, time.time() + self.handle_time)
         msg = f'{addr} 加入到聊天室\n' + self.get_client_list()
         logger.info(msg)
-        self.send_admin(msg)
+        await self.send_admin(msg)
+
+        # 每个客户端的连接回调本身就是一个协程,直接在这里监听消息
+        await self.__listen(reader, writer)
 
-        # 加入的客户端各自起一个现成监听消息
-        thread = threading.Thread(target=self.__listen, args=(conn,))
-        thread.start()
+    def __tune_socket(self, conn) -> None:
+        """设置已连接socket的参数
 
-    def __unregister(self, conn: socket.socket, broke=False) -> None:
+        聊天消息都很小,关闭Nagle算法避免每条消息被延迟发送;缓冲区大小只在指定时才修改
+        """
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    async def __unregister(self, writer: asyncio.StreamWriter, broke=False) -> None:
         """注销连接"""
 
-        if conn in self.clients:
-            addr = self.clients.pop(conn).addr
+        if writer in self.clients:
+            info = self.clients.pop(writer)
+            info.closed = True  # abort后StreamReader中可能还有已经收到的消息,__listen不再处理
+            self.clients_by_addr.pop(info.addr, None)
+            self.__clients_changed()
+            if info.flush_handle is not None:
+                info.flush_handle.cancel()
+            addr = info.addr
+            writer.close()
             if broke:
                 msg = f'{addr} 异常断开\n' + self.get_client_list()
             else:
                 msg = f'{addr} 离开了聊天室\n' + self.get_client_list()
             logger.info(msg)
-            self.send_admin(msg)
+            await self.send_admin(msg)
 
-    def __handle_msg(self, conn: socket.socket, msg: str):
+    async def __handle_msg(self, writer: asyncio.StreamWriter, msg: bytes):
         """处理客户端发送来的消息"""
-        sender_info = self.clients[conn]
+        sender_info = self.clients[writer]
         sender_info.handle_time = time.time()  # 收到客户端消息则更新清理时间
-        if msg.startswith('@'):  # 私聊
-            # 对msg进行解析,判断是否为私聊
-            # '@127.0.0.1:8888 私聊吧'
-            addr, msg = msg.split('@')[-1].split(' ')
-            self.__broadcast_msg(sender_info.addr, msg, is_private=True, receiver_addr=addr)
+        if msg.startswith(b'@'):  # 私聊
+            # 直接在bytes上解析,第一个空格前是地址,后面都是消息
+            # b'@127.0.0.1:8888 私聊吧'
+            addr, _, msg = msg[1:].partition(b' ')
+            await self.__broadcast_msg(sender_info, msg, is_private=True, receiver_addr=self._decode(addr))
         else:  # 群发
-            self.__broadcast_msg(sender_info.addr, msg)
+            await self.__broadcast_msg(sender_info, msg)
 
-    def __broadcast_msg(
+    async def __broadcast_msg(
             self,
-            sender_addr: str,
-            msg: str,
+            sender: ClientInfo,
+            msg: bytes,
             is_private: bool = False,
             receiver_addr: Optional[str] = None,
     ) -> None:
         """转发消息"""
-        clients = {info.addr: skt for skt, info in self.clients.items()}
-        sender = clients[sender_addr]
         # 私聊消息
         if is_private:
-            self.send_private(sender_addr, msg, receiver_addr)
+            await self.send_private(sender.addr, self._decode(msg), receiver_addr)
         # 公聊
         else:
-            self.send_public(sender_addr, msg)
+            await self.send_public(sender, msg)
 
-    def send_private(self, sender_addr: str, msg: str, receiver_addr: str):
-        clients = {info.addr: skt for skt, info in self.clients.items()}
-        sender = clients[sender_addr]
-        if receiver_addr in clients:
+    async def send_private(self, sender_addr: str, msg: str, receiver_addr: str):
+        if receiver_addr in self.clients_by_addr:
             msg = f'来自 {sender_addr}的私聊: {msg}\n'
-            skt = clients[receiver_addr]
-            skt.send(msg.encode(encoding=self.encoding))
+            writer = self.clients_by_addr[receiver_addr]
         else:
             msg = f'管理员: 私聊失败, {receiver_addr}未找到\n'
-            sender.send(msg.encode(encoding=self.encoding))
-
-    def send_public(self, sender_addr, msg):
-        clients = {info.addr: skt for skt, info in self.clients.items()}
-        sender = clients[sender_addr]
-        msg = f'{sender_addr}: {msg}\n'
-        for skt, info in self.clients.items():
-            skt.send(msg.encode(encoding=self.encoding))
-            # if skt != sender:  # 不将信息发给自己
-            #     skt.send(msg.encode(encoding=self.encoding))
-
-    def send_admin(self, msg: str):
-        msg = f'管理员: {msg}\n'
-        for conn, info in self.clients.items():
-            conn.send(msg.encode(encoding=self.encoding))
-
-    def __listen(self, conn: socket.socket) -> None:
-        client = self.clients.get(conn)
+            writer = self.clients_by_addr[sender_addr]
+        if not self.__queue(writer, self._encode_msg(msg)):
+            await self.__drop_slow(writer)
+
+    async def send_public(self, sender: ClientInfo, msg: bytes):
+        # 直接转发收到的bytes,不做解码再编码
+        # 每次群发只拼接一次,join一次分配好结果,不产生prefix + msg的中间对象
+        payload = b''.join((sender.prefix_bytes, msg, b'\n'))
+        await self.__send_all(payload)
+
+    async def send_admin(self, msg: str):
+        payload = self._encode(f'管理员: {msg}\n')
+        await self.__send_all(payload)
+
+    async def __send_all(self, payload: bytes):
+        """把消息放入所有客户端的发送缓冲区
+
+        不等待任何客户端把数据收走,接收太慢的客户端直接断开,不会拖慢其他客户端
+        """
+        slow = [writer for writer in self._client_writers if not self.__queue(writer, payload)]
+        for writer in slow:
+            await self.__drop_slow(writer)
+
+    def __queue(self, writer: asyncio.StreamWriter, payload: bytes) -> bool:
+        """追加消息到客户端的发送缓冲区,攒够batch_max_bytes或等待batch_interval后合并写出
+
+        返回:
+            积压的数据是否还在max_backlog_bytes以内
+        """
+        info = self.clients[writer]
+        info.outbuf += payload
+        if len(info.outbuf) >= self.batch_max_bytes:
+            self.__flush(writer)
+        elif info.flush_handle is None:
+            info.flush_handle = asyncio.get_running_loop().call_later(self.batch_interval, self.__flush, writer)
+        return writer.transport.get_write_buffer_size() + len(info.outbuf) <= self.max_backlog_bytes
+
+    async def __drop_slow(self, writer: asyncio.StreamWriter):
+        """断开接收太慢的客户端,丢弃积压的数据"""
+        info = self.clients.get(writer)
+        if info is None:
+            return
+        logger.warning(f'{info.addr} 积压超过{self.max_backlog_bytes}字节,断开连接')
+        writer.transport.abort()
+        await self.__unregister(writer, True)
+
+    def __flush(self, writer: asyncio.StreamWriter):
+        """把客户端发送缓冲区中的数据一次性写出"""
+        info = self.clients.get(writer)
+        if info is None:
+            return
+        if info.flush_handle is not None:
+            info.flush_handle.cancel()
+            info.flush_handle = None
+        if info.outbuf:
+            data, info.outbuf = info.outbuf, bytearray()
+            writer.write(data)
+
+    async def __listen(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """按长度头读取客户端的消息
+
+        StreamReader自带缓冲,一次从socket读到的多条消息会依次从缓冲区中取出
+        """
+        client = self.clients.get(writer)
         logger.info(f'开始监听 {client.addr}')
         while True:
             try:
-                msg = conn.recv(self.buffer_size)
-                if msg:
-                    self.__handle_msg(conn, msg.decode(self.encoding))
-                else:  # 客户端调用了close
-                    self.__unregister(conn)
-                    break
-            except ConnectionResetError as e:
+                header = await reader.readexactly(HEADER.size)
+                msg = await reader.readexactly(HEADER.unpack(header)[0])
+            except ConnectionResetError:
                 # 客户端异常断开
-                self.__unregister(conn, False)
+                await self.__unregister(writer, True)
                 break
-            except OSError as e:
-                if isinstance(e, TimeoutError):  # 客户端无响应超时
-                    logger.warning(f'{client.addr} 长时间没得到响应')
-                    continue
-                if client.closed:
-                    break
-                raise e
+            except asyncio.IncompleteReadError:  # 客户端调用了close
+                await self.__unregister(writer)
+                break
+            if client.closed:  # 已经被清理或断开
+                break
+            await self.__handle_msg(writer, msg)
+
+    def __clients_changed(self):
+        """客户端加入或离开后更新快照,在线列表等用到时再重新生成"""
+        self._client_list_cache = None
+        self._client_writers = tuple(self.clients)
 
     def get_client_list(self):
-        clients_info = '当前在线用户\n'
-        return clients_info + '\n'.join([f'{info.addr}' for client, info in self.clients.items()]) + '\n'
+        if self._client_list_cache is None:  # 有客户端加入或离开后才重新生成
+            clients_info = '当前在线用户\n'
+            self._client_list_cache = clients_info + '\n'.join([info.addr for info in self.clients.values()]) + '\n'
+        return self._client_list_cache
+
+    def __schedule_expiry(self, writer: asyncio.StreamWriter, expire_time: float):
+        heapq.heappush(self.expirations, (expire_time, next(self.expiry_seq), writer))
+
+    async def clean_client(self):
+        """清理客户端
 
-    def clean_client(self):
-        """清理客户端"""
-        logger.info('清理线程已启动...')
+        每次只处理堆顶已经到期的记录,然后睡到下一个到期时间
+        """
+        logger.info('清理协程已启动...')
         while True:
             now_time = time.time()
-            for conn in list(self.clients.keys()):
-                info = self.clients[conn]
-                if now_time - self.handle_time > info.handle_time:
-                    info.closed = True
-                    self.clients.pop(conn)
-                    conn.send(f'管理员: 你长时间没聊天被管理员踢出来了'.encode(encoding=self.encoding))
-                    conn.shutdown(socket.SHUT_RDWR)
-                    conn.close()
-                    logger.info(f'{info.addr} 被清理了')
-            time.sleep(1)
+            while self.expirations and self.expirations[0][0] <= now_time:
+                _, _, writer = heapq.heappop(self.expirations)
+                info = self.clients.get(writer)
+                if info is None:  # 已经离开
+                    continue
+                if now_time - info.handle_time < self.handle_time:  # 期间发过消息,按最新的时间重新入堆
+                    self.__schedule_expiry(writer, info.handle_time + self.handle_time)
+                    continue
+                info.closed = True
+                self.__flush(writer)
+                self.clients.pop(writer)
+                self.clients_by_addr.pop(info.addr, None)
+                self.__clients_changed()
+                writer.write(self._encode('管理员: 你长时间没聊天被管理员踢出来了\n'))
+                writer.close()
+                logger.info(f'{info.addr} 被清理了')
+            # 堆为空时新加入的客户端最早也要handle_time后才到期
+            await asyncio.sleep(self.expirations[0][0] - now_time if self.expirations else self.handle_time)
+
+    async def __serve(self):
+        await self.__init()
+        logger.info('服务器开始监听连接...')
+        cleaner = asyncio.create_task(self.clean_client())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            cleaner.cancel()
 
     def run(self):
         """服务器启动入口"""
-        self.__init()
-        logger.info('服务器开始监听连接...')
-        thread = threading.Thread(target=self.clean_client)
-        thread.daemon = True
-        thread.start()
-        while True:
-            conn, addr = self.server.accept()
-            addr = f'{addr[0]}:{addr[1]}'
-            self.__register(conn, addr)
+        asyncio.run(self.__serve())
 
 
 if __name__ == '__main__':
@@ -9,45 +9,132 @@
     3.服务器可以给所有用户发消息
 """
 
+import codecs
+import errno
+import functools
+import heapq
+import itertools
+import os
+import select
 import selectors
+import signal
 import socket
+import struct
+import sys
 import time
+from typing import Dict, List, Optional, Set, Tuple
 
 from loguru import logger
 
+HEADER = struct.Struct('!H')  # 客户端消息的长度头: 2字节,网络字节序
+# 没有状态的多字节编码(codecs.lookup规范化后的名字),可以在整个运行期间复用同一个增量编解码器;
+# utf-8-sig、utf-16等编码器有状态(只在第一次输出BOM),不能共用
+STATELESS_MULTIBYTE_CODECS = frozenset(('gbk', 'gb2312', 'gb18030', 'big5', 'big5hkscs', 'cp950',
+                                        'shift_jis', 'cp932', 'euc_jp', 'euc_kr', 'cp949'))
+
+
+def split_frames(buf: bytearray) -> List[bytes]:
+    """从接收缓冲区中取出所有完整的消息,不完整的部分留在缓冲区等下次recv"""
+    frames = []
+    start = 0
+    with memoryview(buf) as view:
+        while len(buf) - start >= HEADER.size:
+            end = start + HEADER.size + HEADER.unpack_from(buf, start)[0]
+            if end > len(buf):
+                break
+            frames.append(view[start + HEADER.size:end].tobytes())
+            start = end
+    del buf[:start]
+    return frames
+
+
+if hasattr(selectors, 'EpollSelector'):
+    class Selector(selectors.EpollSelector):
+        """边缘触发(EPOLLET)的epoll
+
+        就绪状态变化时只通知一次,减少同一个socket被反复唤醒,回调中必须读写到BlockingIOError为止
+        """
+        _EVENT_READ = select.EPOLLIN | select.EPOLLET
+        _EVENT_WRITE = select.EPOLLOUT | select.EPOLLET
+else:
+    Selector = selectors.DefaultSelector
+
 
 class ClientInfo:
-    def __init__(self, addr: str, handle_time: float):
+    __slots__ = ('addr', 'handle_time', 'addr_bytes', 'prefix_bytes', 'outbuf', 'queued_time', 'recv_buf')  # 每个在线客户端一个实例,不需要__dict__
+
+    def __init__(self, addr: str, handle_time: float, encoding: str = 'utf-8'):
         """客户端保持在服务的信息
 
         参数:
             addr:客户端地址
             handle_time:用于清理的标识时间 单位秒
+            encoding:编码
         """
         self.addr = addr
         self.handle_time = handle_time
+        self.addr_bytes = addr.encode(encoding)
+        self.prefix_bytes = self.addr_bytes + b': '  # 群发消息的前缀,注册时编码一次
+        self.outbuf = bytearray()  # 待发送的数据,攒成一批后一次性发出
+        self.queued_time = 0.  # outbuf中最早一条消息的入队时间
+        self.recv_buf = bytearray()  # 收到但还没凑成完整消息的数据
 
 
 class SKTServer:
-    def __init__(self, host: str = '0.0.0.0', port: int = 8888, buffer_size: int = 1024, handle_time: float = 10.,
-                 encoding: str = 'utf-8'):
+    def __init__(self, host: str = '0.0.0.0', port: int = 8888, buffer_size: int = 65536, handle_time: float = 10.,
+                 encoding: str = 'utf-8', sndbuf: Optional[int] = None, rcvbuf: Optional[int] = None,
+                 batch_interval_ms: float = 1., batch_max_bytes: int = 1440, max_backlog_bytes: int = 1024 * 1024,
+                 workers: int = 1):
         """socket服务器初始化函数
 
         参数:
             host:服务器ip
             port:服务器端口
-            buffer_size:接收消息的buffer size
+            buffer_size:每次recv的大小,一次recv可以读到多条消息
             handle_time:清理客户端的时间
             encoding:编码
+            sndbuf:已连接socket的发送缓冲区大小(SO_SNDBUF),为None时使用系统默认值
+            rcvbuf:已连接socket的接收缓冲区大小(SO_RCVBUF),为None时使用系统默认值
+                linux下实际生效的值受net.core.wmem_max/net.core.rmem_max限制
+            batch_interval_ms:消息在发送缓冲区中最多等待的时间 单位毫秒
+            batch_max_bytes:发送缓冲区攒够这么多字节就立即发送,默认约为一个TCP报文段的大小
+            max_backlog_bytes:发送缓冲区最多积压的字节数,超过后认为客户端接收太慢并断开
+            workers:worker进程数,大于1时每个进程都用SO_REUSEPORT监听同一端口,由内核分配新连接,
+                仅支持fork和SO_REUSEPORT的平台(如linux)可用;在线用户列表只包含同一个worker上的客户端;
+                worker之间转发消息不保证送达,对方收件箱已满时消息会被丢弃
         """
         self.host = host
         self.port = port
         self.buffer_size = buffer_size
         self.handle_time = handle_time
         self.encoding = encoding
-        self.selector = selectors.DefaultSelector()  # 根据平台选择最佳的IO多路机制，比如linux就会选择epoll,win只支持select
+        if codecs.lookup(encoding).name in STATELESS_MULTIBYTE_CODECS:  # gbk等编码复用增量编解码器,省掉每次调用时查找、初始化编解码器的开销
+            encode = functools.partial(codecs.getincrementalencoder(encoding)().encode, final=True)
+            self._decode = functools.partial(codecs.getincrementaldecoder(encoding)().decode, final=True)
+        else:  # utf-8等有快速路径,有状态的编码每次调用都从头开始
+            encode = functools.partial(str.encode, encoding=encoding)
+            self._decode = functools.partial(bytes.decode, encoding=encoding)
+        # 相同的文本(管理员通知、在线列表等)只编码一次
+        self._encode = functools.lru_cache(maxsize=256)(encode)
+        self._encode_msg = encode  # 用户的私聊内容每条都不同,不放进缓存,免得把上面的固定文本挤出去
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.batch_interval = batch_interval_ms / 1000
+        self.batch_max_bytes = batch_max_bytes
+        self.max_backlog_bytes = max_backlog_bytes
+        self.selector = Selector()  # linux下使用边缘触发的epoll,其他平台根据平台选择最佳的IO多路机制,win只支持select
         self.server = socket.socket()
         self.clients = {}
+        self.clients_by_addr: Dict[str, socket.socket] = {}  # 地址到socket的索引,私聊时直接查找
+        self._client_list_cache: Optional[str] = None
+        self._client_sockets: Tuple[socket.socket, ...] = ()  # clients的快照,群发时遍历
+        self.pending: Dict[socket.socket, ClientInfo] = {}  # 有待发送的批量消息的客户端,按入队先后排序
+        self.slow_clients: Set[socket.socket] = set()  # 发送缓冲区积压过多,等本轮事件处理完后断开的客户端
+        # 按到期时间排序的小顶堆(到期时间, 序号, 客户端),每个客户端一条记录,序号保证到期时间相同时不比较socket
+        self.expirations: List[Tuple[float, int, socket.socket]] = []
+        self.expiry_seq = itertools.count()
+        self.workers = workers
+        self.peers: List[socket.socket] = []  # 其他worker收件箱的发送端
 
     def __init(self):
         """初始化服务器socket
@@ -59,6 +146,8 @@ class SKTServer:
         logger.info(f'初始化服务器...')
         try:
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 立即释放端口
+            if self.workers > 1:  # 多个worker绑定同一个端口
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server.bind((self.host, self.port))  # 绑定ip 端口
             self.server.listen()  # 开启监听
             self.server.setblocking(False)  # 设置非阻塞
@@ -81,86 +170,335 @@ class SKTServer:
         """
         self.selector.register(skt, events, callback)
 
+    def tune_skt(self, conn: socket.socket):
+        """关闭Nagle算法,并按需调整收发缓冲区"""
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def __clients_changed(self):
+        """客户端加入或离开后更新快照,在线列表用到时再重新生成"""
+        self._client_list_cache = None
+        self._client_sockets = tuple(self.clients)
+
     def __get_client_list(self):
-        clients_info = '当前在线用户\n'
-        return clients_info + '\n'.join([f'{info.addr}' for client, info in self.clients.items()]) + '\n'
+        if self._client_list_cache is None:  # 有客户端加入或离开后才重新生成
+            clients_info = '当前在线用户\n'
+            self._client_list_cache = clients_info + '\n'.join([info.addr for info in self.clients.values()])
+        return self._client_list_cache
 
     def accept(self, skt: socket.socket, mask):
-        """接受客户端连接请求并登录"""
-        conn, addr = skt.accept()
-        conn.setblocking(False)  # 设置非阻塞
-        addr = f'{addr[0]}:{addr[1]}'
-        print(f'{addr}加入到群聊')
-
-        # 添加客户端到用户列表
-        self.clients[conn] = ClientInfo(addr=str(addr), handle_time=time.time())
-        # 转播消息到所有客户端
-        self.broadcast_msg(sender='管理员', msg=f'{addr}加入到群聊\n')
-        self.broadcast_msg(sender='管理员', msg=self.__get_client_list())
-        # 注册客户端加入事件
-        self.register_skt(conn, selectors.EVENT_READ, self.read)
-
-    def broadcast_msg(self, sender: str, msg: str):
-        """转播消息到客户端"""
-
-        if msg.startswith('@'):  # 私聊
-            # 对msg进行解析,判断是否为私聊
-            # '@127.0.0.1:8888 私聊吧'
-            receiver, msg = msg.split('@')[-1].split(' ')
-            self.private_msg(sender, receiver, msg)
-        else:  # 群发
-            for skt, info in self.clients.items():
-                # 不给自己发消息
-                if sender != info.addr:
-                    data = f'{sender}: ' + msg
-                    skt.send(data.encode(encoding=self.encoding))
+        """接受客户端连接请求并登录
+
+        边缘触发下一次通知可能对应多个连接,需要一直accept到BlockingIOError为止
+        """
+        while True:
+            try:
+                conn, addr = skt.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)  # 设置非阻塞
+            self.tune_skt(conn)
+            addr = f'{addr[0]}:{addr[1]}'
+            logger.info(f'{addr}加入到群聊')
+
+            # 添加客户端到用户列表
+            self.clients[conn] = ClientInfo(addr=str(addr), handle_time=time.time(), encoding=self.encoding)
+            self.clients_by_addr[addr] = conn
+            self.__clients_changed()
+            self.schedule_expiry(conn, time.time() + self.handle_time)
+            # 注册客户端加入事件,需要先注册才能在发消息时修改为可写监听
+            self.register_skt(conn, selectors.EVENT_READ, self.handle)
+            # 转播消息到所有客户端
+            self.broadcast_msg(sender='管理员', msg=f'{addr}加入到群聊')
+            self.broadcast_msg(sender='管理员', msg=self.__get_client_list(), relay=False)
+
+    def send_to(self, skt: socket.socket, payload: bytes):
+        """把消息追加到客户端的发送缓冲区
+
+        攒够batch_max_bytes时立即发送,否则由flush_clients在等待超过batch_interval后合并成一次send;
+        发送后仍然积压超过max_backlog_bytes才认为客户端接收太慢
+        """
+        info = self.clients.get(skt)
+        if info is None:  # 发送失败已经被移除
+            return
+        if not info.outbuf:
+            info.queued_time = time.time()
+            self.pending[skt] = info
+        info.outbuf += payload
+        # 在pending中说明没有在等可写事件,等可写时会由write继续发送
+        if skt in self.pending and len(info.outbuf) >= self.batch_max_bytes:
+            self.write(skt)
+        if len(info.outbuf) > self.max_backlog_bytes:  # 可能正在遍历clients,不能在这里直接断开
+            self.slow_clients.add(skt)
+
+    def drop_slow_clients(self):
+        """断开接收太慢的客户端,丢弃积压的数据"""
+        while self.slow_clients:
+            skt = self.slow_clients.pop()
+            if skt in self.clients:
+                info = self.remove_client(skt)
+                logger.warning(f'{info.addr}积压超过{self.max_backlog_bytes}字节,断开连接')
+                self.broadcast_msg(sender='管理员', msg=f'{info.addr}接收太慢被断开')
+
+    def flush_clients(self):
+        """发送攒够一批或已等待足够久的消息"""
+        deadline = time.time() - self.batch_interval
+        for skt, info in list(self.pending.items()):
+            if skt in self.pending and (len(info.outbuf) >= self.batch_max_bytes or info.queued_time <= deadline):
+                self.write(skt)
+
+    def next_timeout(self) -> Optional[float]:
+        """计算select的超时时间,保证最早入队的批量消息能按时发出,最早到期的客户端能按时清理"""
+        deadlines = []
+        if self.pending:
+            info = next(iter(self.pending.values()))
+            deadlines.append(info.queued_time + self.batch_interval)
+        if self.expirations:
+            deadlines.append(self.expirations[0][0])
+        if not deadlines:  # 没有定时任务,有事件才返回
+            return None
+        return max(0., min(deadlines) - time.time())
+
+    def schedule_expiry(self, skt: socket.socket, expire_time: float):
+        """记录客户端的到期时间"""
+        heapq.heappush(self.expirations, (expire_time, next(self.expiry_seq), skt))
+
+    def broadcast_msg(self, sender: str, msg: str, relay: bool = True):
+        """转播消息到客户端
+
+        参数:
+            sender:发送者地址
+            msg:消息
+            relay:是否转发给其他worker
+        """
+        self.send_public(sender, self._encode(msg), relay)
+
+    def send_public(self, sender: str, msg: bytes, relay: bool = True):
+        """群发已经编码好的消息"""
+        sender_skt = self.clients_by_addr.get(sender)
+        # 客户端用注册时编码好的前缀,管理员等其他发送者的前缀由_encode缓存
+        prefix = self.clients[sender_skt].prefix_bytes if sender_skt else self._encode(f'{sender}: ')
+        # 每条消息以换行结尾,所有客户端共用同一份bytes
+        payload = b''.join((prefix, msg, b'\n'))
+        for skt in self._client_sockets:
+            # 不给自己发消息,发送者的socket在循环外查好,循环里只比较对象是否相同
+            if skt is not sender_skt:
+                self.send_to(skt, payload)
+        if relay and self.peers:
+            self.relay(b'P' + payload)
+
+    def handle_msg(self, sender: str, msg: bytes):
+        """处理客户端发送来的消息,判断是私聊还是群发"""
+        if msg.startswith(b'@'):  # 私聊
+            # 直接在bytes上解析,第一个空格前是地址,后面都是消息
+            # b'@127.0.0.1:8888 私聊吧'
+            receiver, _, msg = msg[1:].partition(b' ')
+            self.private_msg(sender, self._decode(receiver), self._decode(msg))
+        else:  # 群发,直接转发收到的bytes,不做解码再编码
+            self.send_public(sender, msg)
 
     def private_msg(self, sender: str, receiver: str, msg: str):
         """私聊信息"""
-        clients = {info.addr: skt for skt, info in self.clients.items()}
-        msg = f'来自{sender}的私聊: {msg}'
-        if receiver in clients:  # 地址正确
-            skt = clients[receiver]
-            skt.send(msg.encode(encoding=self.encoding))
+        msg = f'来自{sender}的私聊: {msg}\n'
+        if receiver in self.clients_by_addr:  # 地址正确
+            skt = self.clients_by_addr[receiver]
+            self.send_to(skt, self._encode_msg(msg))
+        elif self.peers:  # 可能连在其他worker上
+            self.relay(b''.join((b'@', self._encode_msg(receiver), b' ', self._encode_msg(msg))))
         else:  # 地址不正确
             try:
-                self.clients[sender].send(f'私聊失败,{receiver}未找到')
+                skt = self.clients_by_addr[sender]
+                self.send_to(skt, self._encode_msg(f'私聊失败,{receiver}未找到\n'))
             except KeyError as e:
                 logger.error(e)
 
+    def handle(self, client: socket.socket, mask):
+        """客户端事件回调,按事件类型分发到读/写"""
+        if mask & selectors.EVENT_READ and client in self.clients:
+            self.read(client, mask)
+        if mask & selectors.EVENT_WRITE and client in self.clients:
+            self.write(client, mask)
+
+    def write(self, client: socket.socket, mask=None):
+        """把发送缓冲区中的数据发给客户端
+
+        send可能只发出一部分,剩下的留在缓冲区并监听可写事件,等下次可写时继续发送
+        """
+        info = self.clients[client]
+        self.pending.pop(client, None)
+        try:
+            n = client.send(info.outbuf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            logger.error(f'{info.addr}发送失败: {e}')
+            self.remove_client(client)
+            self.broadcast_msg(sender='管理员', msg=f'{info.addr}异常退出')
+            return
+        del info.outbuf[:n]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if info.outbuf else selectors.EVENT_READ
+        if self.selector.get_key(client).events != events:  # 没发完才监听可写事件
+            self.selector.modify(client, events, self.handle)
+
+    def remove_client(self, client: socket.socket):
+        """从用户列表和selectors中移除客户端并关闭连接"""
+        info = self.clients.pop(client)
+        self.clients_by_addr.pop(info.addr, None)
+        self.__clients_changed()
+        self.pending.pop(client, None)
+        self.slow_clients.discard(client)
+        self.selector.unregister(client)
+        client.close()
+        return info
+
     def read(self, client: socket.socket, mask):
-        """接受处理客户端发送过来的消息"""
+        """接受处理客户端发送过来的消息
+
+        每条消息前有HEADER长度头,TCP不保证一次recv正好是一条消息,按长度头从接收缓冲区中切分;
+        边缘触发下同一批数据只通知一次,所以要一直recv到BlockingIOError为止
+        """
         try:
             info = self.clients[client]
             info.handle_time = time.time()
-            msg = client.recv(self.buffer_size)
-            print(f'{info.addr}: {msg.decode(encoding=self.encoding)}')
-            if msg:  # 正常消息
-                msg = msg.decode(encoding=self.encoding)
-                self.broadcast_msg(sender=info.addr, msg=msg)
-            else:  # 客户端调用了close
-                logger.info(f'{info.addr}调用了close')
-                del self.clients[client]
-                self.selector.unregister(client)
-                self.broadcast_msg(sender='管理员', msg=f'{info.addr}退出了群聊\n')
-                self.broadcast_msg(sender='管理员', msg=self.__get_client_list())
+            while True:
+                try:
+                    data = client.recv(self.buffer_size)
+                except BlockingIOError:  # 内核缓冲区已经读空
+                    break
+                if data:  # 正常消息
+                    info.recv_buf += data
+                    for msg in split_frames(info.recv_buf):
+                        # lazy: 日志级别低于debug时不会解码消息;解码失败时替换成占位符,日志不能让服务器退出
+                        logger.opt(lazy=True).debug('{}: {}', lambda: info.addr,
+                                                    lambda: msg.decode(self.encoding, 'replace'))
+                        self.handle_msg(sender=info.addr, msg=msg)
+                    if client not in self.clients:  # 处理消息时给自己发送失败,已经被移除
+                        break
+                else:  # 客户端调用了close
+                    logger.info(f'{info.addr}调用了close')
+                    self.remove_client(client)
+                    self.broadcast_msg(sender='管理员', msg=f'{info.addr}退出了群聊')
+                    self.broadcast_msg(sender='管理员', msg=self.__get_client_list(), relay=False)
+                    break
         except Exception as e:
-            self.selector.unregister(client)
-            del self.clients[client]
-            self.broadcast_msg(sender='管理员', msg=f'{self.clients[client]}异常退出')
+            info = self.remove_client(client)
+            self.broadcast_msg(sender='管理员', msg=f'{info.addr}异常退出')
             logger.error(e)
             raise e
 
+    def relay(self, data: bytes):
+        """把消息转发给其他worker
+
+        转发不保证送达:对方收件箱已满或发送出错时这条消息直接丢弃,不会缓存重发;对方worker已经退出时不再向它转发
+
+        参数:
+            data: b'P' + 群发消息 或 b'@' + 接收者地址 + b' ' + 私聊消息
+        """
+        for peer in tuple(self.peers):
+            try:
+                peer.send(data)
+            except BlockingIOError:
+                logger.warning('worker收件箱已满,消息没有转发出去')
+            except OSError as e:
+                if isinstance(e, ConnectionRefusedError) or e.errno == errno.ENOTCONN:  # 对方worker已经退出
+                    logger.error(f'worker收件箱不可用,不再转发: {e}')
+                    self.peers.remove(peer)
+                    peer.close()
+                else:  # 消息太长等,只丢弃这一条
+                    logger.warning(f'消息没有转发出去: {e}')
+
+    def read_peer(self, inbox: socket.socket, mask):
+        """接收其他worker转发过来的消息,只发给本进程的客户端"""
+        while True:
+            try:
+                data = inbox.recv(1 << 17)
+            except BlockingIOError:
+                return
+            kind, body = data[:1], data[1:]
+            if kind == b'P':  # 群发
+                for skt in self._client_sockets:
+                    self.send_to(skt, body)
+            else:  # 私聊
+                receiver, _, payload = body.partition(b' ')
+                skt = self.clients_by_addr.get(self._decode(receiver))
+                if skt is not None:
+                    self.send_to(skt, payload)
+
     def run(self):
         """服务器启动入口"""
+        if self.workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+            logger.warning('当前平台不支持多进程worker,使用单进程运行')
+            self.workers = 1
+        if self.workers > 1:
+            self.__fork_workers()
+        else:
+            self.__serve()
+
+    def __fork_workers(self):
+        """启动worker进程并等待它们退出
+
+        每个worker有一个数据报socketpair作为收件箱,其他worker通过它的发送端转发群聊/私聊消息
+        """
+        channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(self.workers)]
+        pids = []
+        for index in range(self.workers):
+            pid = os.fork()
+            if pid == 0:  # 子进程
+                try:
+                    self.__start_worker(index, channels)
+                except KeyboardInterrupt:
+                    pass
+                except Exception as e:
+                    logger.error(e)
+                    os._exit(1)
+                os._exit(0)
+            pids.append(pid)
+        for inbox, outbox in channels:
+            inbox.close()
+            outbox.close()
+        logger.info(f'已启动{self.workers}个worker进程')
+        # SIGTERM默认直接结束进程,不会执行finally;转成SystemExit,保证worker跟着退出
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            for pid in pids:
+                os.waitpid(pid, 0)
+        finally:  # 主进程退出时结束所有worker
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def __start_worker(self, index: int, channels: List[Tuple[socket.socket, socket.socket]]):
+        """worker进程入口,使用自己的selector和监听socket"""
+        self.selector.close()
+        self.server.close()
+        self.selector = Selector()
+        self.server = socket.socket()
+        for i, (inbox, outbox) in enumerate(channels):
+            if i == index:
+                outbox.close()
+                inbox.setblocking(False)
+                self.register_skt(inbox, selectors.EVENT_READ, self.read_peer)
+            else:
+                inbox.close()
+                outbox.setblocking(False)
+                self.peers.append(outbox)
+        self.__serve()
+
+    def __serve(self):
+        """单个进程的事件循环"""
         # 初始化服务器
         self.__init()
         # 第一次调用server，register accept
         # 第二次调用client，register read
         while True:
-            # timeout 为None时是有事件才处理也就是阻塞的
             self.clean_client()
-            events = self.selector.select(timeout=1)  # 调用select：优先使用epoll
+            # 超时时间为下一个定时任务(批量发送/清理客户端)的到期时间,没有定时任务时为None,有事件才返回
+            events = self.selector.select(timeout=self.next_timeout())  # 调用select：优先使用epoll
             # 只要不阻塞就有调用的数据，返回一个列表
             # 默认阻塞，有活动链接就返回活动的链接列表
             for key, mask in events:
@@ -169,20 +507,35 @@ class SKTServer:
                 # 获取函数内存地址，加入参数
                 # key.fileobj = 文件句柄
                 callback(key.fileobj, mask)
+            self.drop_slow_clients()
+            # 本轮产生的消息按客户端合并后再发送
+            self.flush_clients()
 
     def clean_client(self):
-        """清理客户端"""
+        """清理客户端
+
+        只检查堆顶已经到期的记录;期间发过消息的客户端按最新的时间重新入堆
+        """
         now_time = time.time()
-        for skt in list(self.clients.keys()):
-            info = self.clients[skt]
-            if now_time - self.handle_time > info.handle_time:
-                del self.clients[skt]
-                self.selector.unregister(skt)
-                skt.send(f'管理员: 你长时间没聊天被管理员踢出来了'.encode(encoding=self.encoding))
-                skt.close()
-                print(f'{info.addr}: 需要被清理了')
+        while self.expirations and self.expirations[0][0] <= now_time:
+            _, _, skt = heapq.heappop(self.expirations)
+            info = self.clients.get(skt)
+            if info is None:  # 已经离开
+                continue
+            if now_time - info.handle_time < self.handle_time:  # 空闲时间还没超过handle_time
+                self.schedule_expiry(skt, info.handle_time + self.handle_time)
+            else:
+                # 踢出通知排在还没发出的消息后面,关闭前尽量一起发出;发送缓冲区已满时剩下的直接丢弃
+                self.send_to(skt, self._encode('管理员: 你长时间没聊天被管理员踢出来了\n'))
+                if skt in self.clients:
+                    self.write(skt)
+                if skt in self.clients:  # 发送失败时write已经移除了客户端
+                    self.remove_client(skt)
+                logger.info(f'{info.addr}: 需要被清理了')
 
 
 if __name__ == '__main__':
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', enqueue=True)  # 日志由后台线程写出,不阻塞事件循环
     server = SKTServer(encoding='gbk', handle_time=20)
     server.run()
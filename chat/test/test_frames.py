@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+from chat.multiplexing.server import HEADER, split_frames
+
+
+def frame(body: bytes) -> bytes:
+    return HEADER.pack(len(body)) + body
+
+
+class SplitFramesTest(unittest.TestCase):
+    def test_merged_frames(self):
+        """一次recv读到多条消息"""
+        buf = bytearray(frame(b'hello') + frame('你好'.encode('utf-8')) + frame(b''))
+        self.assertEqual(split_frames(buf), [b'hello', '你好'.encode('utf-8'), b''])
+        self.assertEqual(buf, b'')
+
+    def test_partial_frame(self):
+        """不完整的消息留在缓冲区,等下次recv补齐"""
+        data = frame(b'first') + frame(b'second')
+        buf = bytearray(data[:-3])
+        self.assertEqual(split_frames(buf), [b'first'])
+        self.assertEqual(buf, frame(b'second')[:-3])
+        buf += data[-3:]
+        self.assertEqual(split_frames(buf), [b'second'])
+        self.assertEqual(buf, b'')
+
+    def test_partial_header(self):
+        """长度头本身也可能被拆开"""
+        data = frame(b'x' * 300)
+        buf = bytearray(data[:1])
+        self.assertEqual(split_frames(buf), [])
+        self.assertEqual(buf, data[:1])
+        buf += data[1:]
+        self.assertEqual(split_frames(buf), [b'x' * 300])
+
+
+if __name__ == '__main__':
+    unittest.main()